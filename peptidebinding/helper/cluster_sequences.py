@@ -1,6 +1,5 @@
 """Clusters sequences and uses this clustering to partition dataset into
 e.g. training and test sets."""
-import json
 import logging
 import random
 import re
@@ -13,11 +12,13 @@ from Bio.Alphabet import IUPAC
 import numpy as np
 import pandas as pd
 
+import peptidebinding.helper.utils as utils
+
 
 def generate_cdr_sequence_record(row):
     """Generates a Bio.SeqRecord for the CDR sequence in a given row, with
     name containing information about the rest of the row."""
-    indices = json.loads(row.cdr_bp_id_str)
+    indices = utils.decode_bp_indices(row.cdr_bp_id_str)
     start_ind = indices[0]
     end_ind = indices[-1]
     name = "_".join(map(str, [row.cdr_pdb_id,
@@ -36,7 +37,7 @@ def generate_cdr_sequence_record(row):
 def generate_target_sequence_record(row):
     """Generates a Bio.SeqRecord for the target sequence in a given row, with
     name containing information about the rest of the row."""
-    indices = json.loads(row.target_bp_id_str)
+    indices = utils.decode_bp_indices(row.target_bp_id_str)
     start_ind = indices[0]
     end_ind = indices[-1]
     name = "_".join(map(str, [row.target_pdb_id,
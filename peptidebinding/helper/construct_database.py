@@ -1,5 +1,6 @@
 """Constructs database of interacting fragments."""
 import logging
+import os
 
 import numpy as np
 import pandas as pd
@@ -11,25 +12,27 @@ import peptidebinding.helper.utils as utils
 def read_matrix_from_file(pdb_id):
     """Reads interaction matrix from file and return as np.array.
 
+    The matrix is memory-mapped rather than read into memory, so only the
+    rows that are actually used will be paged in from disk. The returned
+    array is read-only - callers that need to modify it should take a copy.
+
     Args:
         pdb_id (string): string of PDB ID e.g. "2zxx".
 
     Returns:
         np.array: interaction matrix as an np.array
     """
-    ids_filename = utils.get_id_filename(pdb_id)
     matrix_filename = utils.get_matrix_filename(pdb_id)
 
-    # Read in residue IDs
-    ids = pd.read_csv(ids_filename, sep=" ", header=None)
-    num_residues = ids.shape[0]
-
-    # Read in binary matrix
-    with open(matrix_filename, 'rb') as f:
-        raw = np.fromfile(f, np.int32)
+    # The matrix is square int32, so its dimensions follow from the file size
+    #   without having to parse the ids file
+    num_residues = int(round((os.path.getsize(matrix_filename) / 4) ** 0.5))
 
-    # Found dimensions from corresponding ids.txt file
-    matrix = raw.reshape((num_residues, num_residues))
+    # Map the binary matrix into memory rather than reading it all in
+    matrix = np.memmap(matrix_filename,
+                       dtype=np.int32,
+                       mode='r',
+                       shape=(num_residues, num_residues))
 
     return matrix
 
@@ -50,7 +53,9 @@ def read_matrix_from_file_df(pdb_id):
 
     # Combine the three columns into one label for each residue
     ids = pd.read_csv(ids_filename, sep=" ", header=None)
-    combined_labels = ids.apply(lambda x: '_'.join(x.map(str)), axis=1)
+    combined_labels = (ids.iloc[:, 0].astype(str) + '_' +
+                       ids.iloc[:, 1].astype(str) + '_' +
+                       ids.iloc[:, 2].astype(str))
 
     df = pd.DataFrame(matrix, index=combined_labels, columns=combined_labels)
     return df
@@ -69,14 +74,16 @@ def find_target_indices_from_matrix(matrix, cdr_indices):
     Returns:
         array: array of indices that interact with any of the indices of CDR.
     """
-    target_indices_np = ((matrix.iloc[cdr_indices, :] < 0).sum(axis=0) > 0).to_numpy().nonzero()
-    target_indices = list(target_indices_np[0])
+    # Accept either an np.array or a labelled data frame read in by
+    #   read_matrix_from_file_df
+    matrix = np.asarray(matrix)
 
-    for index in cdr_indices:
-        if index in target_indices:
-            target_indices.remove(index)
+    # A residue is a target if it interacts with any CDR residue, but
+    #   residues of the CDR itself don't count
+    mask = np.any(matrix[cdr_indices, :] < 0, axis=0)
+    mask[cdr_indices] = False
 
-    return target_indices
+    return np.flatnonzero(mask).tolist()
 
 
 def combine_bound_pairs(filename_list):
@@ -103,61 +110,88 @@ def remove_duplicate_rows(data_frame, columns):
     """
     logging.info(f"Removing duplicates from dataframe with {len(data_frame)} rows, "
                  f"based on the columns {columns}.")
-    row_is_duplicate = data_frame.duplicated(columns, keep='first')
-    no_duplicates = data_frame[~ row_is_duplicate]
+    no_duplicates = data_frame.drop_duplicates(subset=columns, keep='first')
     logging.info(f"After removing duplicates based on columns {columns}, data frame "
                  f"now has {len(no_duplicates)} rows.")
 
     return no_duplicates
 
 
-def generate_proposal_negatives(data_frame, k):
-    """Given a data frame, shuffle and pair the rows to produce a set of k proposal
-    negative examples. Return these in a data frame."""
+def generate_proposal_negatives(data_frame, k, rng):
+    """Given a data frame, pair random rows to produce a set of k proposal
+    negative examples, drawing rows with the given numpy random generator.
+    Return these in a data frame."""
     logging.info(f"Generating {k} negatives for data frame of length {len(data_frame)}")
 
-    proposals_df = data_frame.sample(n=k, replace=True).reset_index(drop=True).join(
-        data_frame.sample(n=k, replace=True).reset_index(drop=True),
+    acceptor_rows = rng.integers(0, len(data_frame), k)
+    donor_rows = rng.integers(0, len(data_frame), k)
+    proposals_df = data_frame.iloc[acceptor_rows].reset_index(drop=True).join(
+        data_frame.iloc[donor_rows].reset_index(drop=True),
         rsuffix="_donor")
 
     logging.info(f"Updating column values for these proposals")
-    proposals_df['original_cdr_bp_id_str'] = proposals_df['cdr_bp_id_str']
-    proposals_df['original_cdr_resnames'] = proposals_df['cdr_resnames']
-    proposals_df['original_cdr_pdb_id'] = proposals_df['cdr_pdb_id']
-
-    proposals_df['cdr_bp_id_str'] = proposals_df['cdr_bp_id_str_donor']
-    proposals_df['cdr_resnames'] = proposals_df['cdr_resnames_donor']
-    proposals_df['cdr_pdb_id'] = proposals_df['cdr_pdb_id_donor']
-
-    proposals_df['binding_observed'] = 0
-
-    proposals_df['paired'] = list(zip(proposals_df['cdr_resnames'],
-                                      proposals_df['target_resnames']))
+    proposals_df = proposals_df.assign(
+        original_cdr_bp_id_str=proposals_df['cdr_bp_id_str'],
+        original_cdr_resnames=proposals_df['cdr_resnames'],
+        original_cdr_pdb_id=proposals_df['cdr_pdb_id'],
+        original_cdr_enc_id=proposals_df['cdr_enc_id'],
+        binding_observed=0)
+
+    cdr_cols = ['cdr_bp_id_str', 'cdr_resnames', 'cdr_pdb_id']
+    donor_cols = [col + '_donor' for col in cdr_cols]
+    proposals_df[cdr_cols] = proposals_df[donor_cols].to_numpy()
+    proposals_df['cdr_enc_id'] = proposals_df['cdr_enc_id_donor'].to_numpy()
 
     logging.info(f"Updated column values for these proposals")
 
     return proposals_df
 
 
-def remove_invalid_negatives(combined_df):
+def remove_invalid_negatives(combined_df, cdr_encodings, target_encodings):
     """Finds similarity between the rows that have been combined to form negatives
     and removes any that are formed by rows that are too similar. Judged by
-    sequence alignment between CDRs and targets."""
+    sequence alignment between CDRs and targets.
+
+    cdr_encodings and target_encodings are lists of integer-encoded sequences,
+    indexed by the cdr_enc_id and target_enc_id columns of the data frame."""
     new_negatives_rows = (combined_df['binding_observed'] == 0) & \
                          (np.isnan(combined_df['similarity_score']))
     logging.info(f"Verifying {(new_negatives_rows).sum()} new negatives")
 
-    cdr_scores = distances.calculate_alignment_scores(combined_df.loc[new_negatives_rows,
-                                                                      'cdr_resnames'],
-                                                      combined_df.loc[new_negatives_rows,
-                                                                      'original_cdr_resnames'])
-    target_scores = distances.calculate_alignment_scores(combined_df.loc[new_negatives_rows,
-                                                                         'target_resnames'],
-                                                         combined_df.loc[new_negatives_rows,
-                                                                         'target_resnames_donor'])
+    cdr_enc = [cdr_encodings[ind]
+               for ind in combined_df.loc[new_negatives_rows, 'cdr_enc_id']]
+    original_cdr_enc = [cdr_encodings[ind]
+                        for ind in combined_df.loc[new_negatives_rows,
+                                                   'original_cdr_enc_id']]
+    target_enc = [target_encodings[ind]
+                  for ind in combined_df.loc[new_negatives_rows, 'target_enc_id']]
+    target_donor_enc = [target_encodings[ind]
+                        for ind in combined_df.loc[new_negatives_rows,
+                                                   'target_enc_id_donor']]
+
+    # Most proposals are rejected for being too similar, and a cheap O(p)
+    #   lower bound on the alignment score is enough to prove rejection
+    #   (score >= 0) for the bulk of them without running the full quadratic
+    #   alignment. Rows whose bound is inconclusive get the exact score.
+    lower_bounds = \
+        distances.calculate_alignment_lower_bounds_encoded(cdr_enc, original_cdr_enc) + \
+        distances.calculate_alignment_lower_bounds_encoded(target_enc, target_donor_enc)
+    uncertain = np.flatnonzero(lower_bounds < 0)
+    logging.info(f"Lower bounds prove {len(lower_bounds) - len(uncertain)} rejections; "
+                 f"computing exact scores for the remaining {len(uncertain)} rows")
+
+    total_scores = lower_bounds
+    if len(uncertain) > 0:
+        # Score the CDR and target pairs in a single batched kernel call,
+        #   then split the results and sum
+        scores = distances.calculate_alignment_scores_encoded(
+            [cdr_enc[ind] for ind in uncertain] +
+            [target_enc[ind] for ind in uncertain],
+            [original_cdr_enc[ind] for ind in uncertain] +
+            [target_donor_enc[ind] for ind in uncertain])
+        total_scores[uncertain] = scores[:len(uncertain)] + scores[len(uncertain):]
 
     logging.info(f"Computed scores")
-    total_scores = [sum(scores) for scores in zip(cdr_scores, target_scores)]
     combined_df.loc[new_negatives_rows, 'similarity_score'] = total_scores
 
     too_similar_indices = combined_df.index[(combined_df['similarity_score'] >= 0)]
@@ -192,7 +226,8 @@ def generate_negatives_alignment_threshold(bound_pairs_df, k=None, seed=42):
     For each of cdr, target and original_cdr there are fields for PDB id, biopython
     ID string and resnames.
     """
-    np.random.seed(seed)
+    # pylint: disable=too-many-locals
+    rng = np.random.default_rng(seed)
 
     positives_df = bound_pairs_df.copy()
     positives_df['cdr_pdb_id'] = positives_df['pdb_id']
@@ -201,12 +236,30 @@ def generate_negatives_alignment_threshold(bound_pairs_df, k=None, seed=42):
     positives_df['binding_observed'] = 1
     positives_df['similarity_score'] = np.nan
 
-    considered_pairs = {x for x in zip(positives_df['cdr_resnames'],
-                                       positives_df['target_resnames'])}
+    # Encode each unique resname string once up front - the alignment kernel
+    #   works on the integer encodings, and rows carry the (much smaller)
+    #   encoding IDs through the shuffles instead of re-encoding per round
+    cdr_uniq, cdr_inverse = np.unique(positives_df['cdr_resnames'],
+                                      return_inverse=True)
+    cdr_encodings = [distances.encode_sequence(seq) for seq in cdr_uniq]
+    positives_df['cdr_enc_id'] = cdr_inverse
+
+    target_uniq, target_inverse = np.unique(positives_df['target_resnames'],
+                                            return_inverse=True)
+    target_encodings = [distances.encode_sequence(seq) for seq in target_uniq]
+    positives_df['target_enc_id'] = target_inverse
+
+    # Each (cdr, target) pair is tracked as a single packed int64 built from
+    #   the two encoding IDs - far smaller than a set of string tuples and
+    #   membership testing is plain integer hashing
+    considered_pairs = set(((cdr_inverse.astype(np.int64) << 32) |
+                            target_inverse.astype(np.int64)).tolist())
 
     negatives_dfs_arr = []
     num_negatives_produced = 0
-    num_rounds = 0
+
+    checkpoint_filename = ".tmp.negatives_df.csv"
+    checkpoint_header_written = False
 
     if k is None:
         k = len(bound_pairs_df.index)
@@ -221,7 +274,7 @@ def generate_negatives_alignment_threshold(bound_pairs_df, k=None, seed=42):
         #   batches of 20000 to avoid issues with the command line tools
         num_proposals = min(3 * k, 1000000)
         logging.info("Generating new proposals")
-        proposals_df = generate_proposal_negatives(positives_df, num_proposals)
+        proposals_df = generate_proposal_negatives(positives_df, num_proposals, rng)
 
         # Remove rows that are duplicated in the proposals
         logging.info("Removing duplicated proposals")
@@ -232,18 +285,26 @@ def generate_negatives_alignment_threshold(bound_pairs_df, k=None, seed=42):
         #   postives data frame
         logging.info(f"Removing proposals already considered. "
                      f"Starting with {len(proposals_df)} rows.")
-        proposals_df = proposals_df[~ proposals_df['paired'].isin(considered_pairs)]
+        pair_keys = (proposals_df['cdr_enc_id'].to_numpy(dtype=np.int64) << 32) | \
+                    proposals_df['target_enc_id'].to_numpy(dtype=np.int64)
+        not_considered = np.fromiter((key not in considered_pairs
+                                      for key in pair_keys.tolist()),
+                                     dtype=bool,
+                                     count=len(pair_keys))
+        proposals_df = proposals_df[not_considered]
         logging.info(f"After removing proposals already considered, there are "
                      f"{len(proposals_df)} rows.")
 
         # Add these proposals to considered pairs so we don't check them again later
         logging.info(f"Adding these {len(proposals_df)} proposals to considered list, "
                      f"to allow checking in next round.")
-        considered_pairs.update(proposals_df['paired'])
+        considered_pairs.update(pair_keys[not_considered].tolist())
 
         # Perform alignment for these proposals and check they are reasonable negatives
         logging.info("Removing invalid negatives based on alignment")
-        negatives_df = remove_invalid_negatives(proposals_df)
+        negatives_df = remove_invalid_negatives(proposals_df,
+                                                cdr_encodings,
+                                                target_encodings)
 
         num_negatives_produced += len(negatives_df)
         negatives_dfs_arr.append(negatives_df)
@@ -251,18 +312,17 @@ def generate_negatives_alignment_threshold(bound_pairs_df, k=None, seed=42):
         logging.info(f"Progress: {num_negatives_produced/k:.2%}. "
                      f"Generated {num_negatives_produced} negatives so far.")
 
-        if num_rounds % 10 == 0:
-            filename = f".tmp.negatives_df_{num_negatives_produced}.csv"
-            logging.info(f"Saving data frame so far to file {filename}: "
-                         f"concatenating {len(negatives_dfs_arr)} data frames.")
-            # Save the data frame as a checkpoint
-            combined_df = pd.concat(negatives_dfs_arr, sort=False).reset_index(
-                drop=True)
-            logging.info(f"Saving data frame so far to file {filename}: saving to file.")
-            combined_df.to_csv(filename)
-            logging.info("Saved to file.")
-
-        num_rounds += 1
+        # Append just this round's negatives to the checkpoint file, so
+        #   checkpointing stays proportional to the per-round work rather
+        #   than re-writing the whole growing list every time
+        logging.info(f"Appending {len(negatives_df)} negatives to checkpoint "
+                     f"file {checkpoint_filename}.")
+        negatives_df.to_csv(checkpoint_filename,
+                            mode='a' if checkpoint_header_written else 'w',
+                            header=not checkpoint_header_written,
+                            index=False)
+        checkpoint_header_written = True
+        logging.info("Saved checkpoint.")
 
     logging.info(f"Concatenating all negatives with the positives into a new data frame. "
                  f"There are {len(negatives_dfs_arr)} data frames containing negatives.")
@@ -273,7 +333,9 @@ def generate_negatives_alignment_threshold(bound_pairs_df, k=None, seed=42):
                  f"{num_negatives_produced - k} rows from the negatives.")
     combined_df = combined_df.iloc[:len(positives_df) + k, :]
 
-    good_cols = [col for col in combined_df.columns if not col.endswith('donor')]
+    # Drop the donor columns and the internal encoding IDs
+    good_cols = [col for col in combined_df.columns
+                 if not col.endswith('donor') and not col.endswith('enc_id')]
     combined_df = combined_df[good_cols]
 
     return combined_df
@@ -289,6 +351,11 @@ def split_dataset_random(data_frame, group_proportions, seed=42):
     logging.info(f"Intended fractions are {fractions}")
     counts = list(map(int, (fractions * len(data_frame))))
     logging.info(f"Intended counts per group are {counts}")
-    grouped_dfs = np.split(data_frame.sample(frac=1, random_state=seed), counts)
+
+    # Shuffle an integer index and slice with iloc, rather than materialising
+    #   a full shuffled copy of the data frame with sample(frac=1)
+    rng = np.random.default_rng(seed)
+    index_groups = np.split(rng.permutation(len(data_frame)), counts)
+    grouped_dfs = [data_frame.iloc[group] for group in index_groups]
 
     return grouped_dfs
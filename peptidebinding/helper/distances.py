@@ -4,6 +4,235 @@ import re
 import subprocess
 
 import numpy as np
+from numba import njit, prange
+
+# BLOSUM62 substitution matrix, as used by seq-align's needleman_wunsch
+#   with the --scoring BLOSUM62 option. Unknown residues are mapped to 'X'.
+alignment_alphabet = "ARNDCQEGHILKMFPSTWYVBZX"
+# pylint: disable=bad-whitespace
+_BLOSUM62 = np.array(
+    [[ 4, -1, -2, -2,  0, -1, -1,  0, -2, -1, -1, -1, -1, -2, -1,  1,  0, -3, -2,  0, -2, -1,  0],
+     [-1,  5,  0, -2, -3,  1,  0, -2,  0, -3, -2,  2, -1, -3, -2, -1, -1, -3, -2, -3, -1,  0, -1],
+     [-2,  0,  6,  1, -3,  0,  0,  0,  1, -3, -3,  0, -2, -3, -2,  1,  0, -4, -2, -3,  3,  0, -1],
+     [-2, -2,  1,  6, -3,  0,  2, -1, -1, -3, -4, -1, -3, -3, -1,  0, -1, -4, -3, -3,  4,  1, -1],
+     [ 0, -3, -3, -3,  9, -3, -4, -3, -3, -1, -1, -3, -1, -2, -3, -1, -1, -2, -2, -1, -3, -3, -2],
+     [-1,  1,  0,  0, -3,  5,  2, -2,  0, -3, -2,  1,  0, -3, -1,  0, -1, -2, -1, -2,  0,  3, -1],
+     [-1,  0,  0,  2, -4,  2,  5, -2,  0, -3, -3,  1, -2, -3, -1,  0, -1, -3, -2, -2,  1,  4, -1],
+     [ 0, -2,  0, -1, -3, -2, -2,  6, -2, -4, -4, -2, -3, -3, -2,  0, -2, -2, -3, -3, -1, -2, -1],
+     [-2,  0,  1, -1, -3,  0,  0, -2,  8, -3, -3, -1, -2, -1, -2, -1, -2, -2,  2, -3,  0,  0, -1],
+     [-1, -3, -3, -3, -1, -3, -3, -4, -3,  4,  2, -3,  1,  0, -3, -2, -1, -3, -1,  3, -3, -3, -1],
+     [-1, -2, -3, -4, -1, -2, -3, -4, -3,  2,  4, -2,  2,  0, -3, -2, -1, -2, -1,  1, -4, -3, -1],
+     [-1,  2,  0, -1, -3,  1,  1, -2, -1, -3, -2,  5, -1, -3, -1,  0, -1, -3, -2, -2,  0,  1, -1],
+     [-1, -1, -2, -3, -1,  0, -2, -3, -2,  1,  2, -1,  5,  0, -2, -1, -1, -1, -1,  1, -3, -1, -1],
+     [-2, -3, -3, -3, -2, -3, -3, -3, -1,  0,  0, -3,  0,  6, -4, -2, -2,  1,  3, -1, -3, -3, -1],
+     [-1, -2, -2, -1, -3, -1, -1, -2, -2, -3, -3, -1, -2, -4,  7, -1, -1, -4, -3, -2, -2, -1, -2],
+     [ 1, -1,  1,  0, -1,  0,  0,  0, -1, -2, -2,  0, -1, -2, -1,  4,  1, -3, -2, -2,  0,  0,  0],
+     [ 0, -1,  0, -1, -1, -1, -1, -2, -2, -1, -1, -1, -1, -2, -1,  1,  5, -2, -2,  0, -1, -1,  0],
+     [-3, -3, -4, -4, -2, -2, -3, -2, -2, -3, -2, -3, -1,  1, -4, -3, -2, 11,  2, -3, -4, -3, -2],
+     [-2, -2, -2, -3, -2, -1, -2, -3,  2, -1, -1, -2, -1,  3, -3, -2, -2,  2,  7, -1, -3, -2, -1],
+     [ 0, -3, -3, -3, -1, -2, -2, -3, -3,  3,  1, -2,  1, -1, -2, -2,  0, -3, -1,  4, -3, -2, -1],
+     [-2, -1,  3,  4, -3,  0,  1, -1,  0, -3, -4,  0, -3, -3, -2,  0, -1, -4, -3, -3,  4,  1, -1],
+     [-1,  0,  0,  1, -3,  3,  4, -2,  0, -3, -3,  1, -1, -3, -1,  0, -1, -3, -2, -2,  1,  4, -1],
+     [ 0, -1, -1, -1, -2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -2,  0,  0, -2, -1, -1, -1, -1, -1]],
+    dtype=np.int32)
+
+# Gap penalties matching the seq-align invocation in run_seq_align_batch.sh:
+#   --gapopen 0 with the default gap extension penalty of -1
+GAP_OPEN = 0
+GAP_EXTEND = -1
+
+# Lookup table from residue character code to row of the substitution matrix
+_RESIDUE_LUT = np.full(256, alignment_alphabet.index('X'), dtype=np.int8)
+for _i, _c in enumerate(alignment_alphabet):
+    _RESIDUE_LUT[ord(_c)] = _i
+
+
+def encode_sequence(sequence):
+    """Encodes a string of one-letter residue codes as an np.array of integers
+    indexing into the substitution matrix. Unknown characters become 'X'."""
+    return _RESIDUE_LUT[np.frombuffer(sequence.encode('ascii'), np.uint8)]
+
+
+@njit(cache=True)
+def _alignment_score(seq1, seq2, score_matrix, gap_open, gap_extend):
+    """Global (Needleman-Wunsch) alignment score with affine gap penalties
+    between two integer-encoded sequences."""
+    # pylint: disable=too-many-locals
+    len1 = seq1.shape[0]
+    len2 = seq2.shape[0]
+
+    neg_inf = np.int32(-(2 ** 30))
+
+    # match[j], gap1[j], gap2[j] hold the best score of an alignment of
+    #   seq1[:i] and seq2[:j] ending in a substitution, a gap in seq1 or a
+    #   gap in seq2 respectively
+    match = np.full(len2 + 1, neg_inf, dtype=np.int32)
+    gap1 = np.full(len2 + 1, neg_inf, dtype=np.int32)
+    gap2 = np.full(len2 + 1, neg_inf, dtype=np.int32)
+
+    match[0] = 0
+    for j in range(1, len2 + 1):
+        gap1[j] = gap_open + gap_extend * j
+
+    for i in range(1, len1 + 1):
+        prev_match = match[0]
+        prev_gap1 = gap1[0]
+        prev_gap2 = gap2[0]
+
+        match[0] = neg_inf
+        gap1[0] = neg_inf
+        gap2[0] = gap_open + gap_extend * i
+
+        for j in range(1, len2 + 1):
+            # Best score ending with seq1[i-1] aligned to seq2[j-1]
+            best_prev = prev_match
+            if prev_gap1 > best_prev:
+                best_prev = prev_gap1
+            if prev_gap2 > best_prev:
+                best_prev = prev_gap2
+            new_match = best_prev + score_matrix[seq1[i - 1], seq2[j - 1]]
+
+            # Best score ending with a gap in seq1 (consuming seq2[j-1])
+            open_gap1 = match[j - 1] + gap_open + gap_extend
+            if gap2[j - 1] + gap_open + gap_extend > open_gap1:
+                open_gap1 = gap2[j - 1] + gap_open + gap_extend
+            extend_gap1 = gap1[j - 1] + gap_extend
+            new_gap1 = open_gap1 if open_gap1 > extend_gap1 else extend_gap1
+
+            # Best score ending with a gap in seq2 (consuming seq1[i-1])
+            open_gap2 = match[j] + gap_open + gap_extend
+            if gap1[j] + gap_open + gap_extend > open_gap2:
+                open_gap2 = gap1[j] + gap_open + gap_extend
+            extend_gap2 = gap2[j] + gap_extend
+            new_gap2 = open_gap2 if open_gap2 > extend_gap2 else extend_gap2
+
+            prev_match = match[j]
+            prev_gap1 = gap1[j]
+            prev_gap2 = gap2[j]
+
+            match[j] = new_match
+            gap1[j] = new_gap1
+            gap2[j] = new_gap2
+
+    best = match[len2]
+    if gap1[len2] > best:
+        best = gap1[len2]
+    if gap2[len2] > best:
+        best = gap2[len2]
+    return best
+
+
+@njit(cache=True)
+def _ungapped_alignment_score(seq1, seq2, score_matrix, gap_open, gap_extend):
+    """Score of the alignment that pairs the two sequences position by
+    position and gaps the overhang. A valid global alignment, so this is a
+    lower bound on the full Needleman-Wunsch score at O(p) cost."""
+    len1 = seq1.shape[0]
+    len2 = seq2.shape[0]
+    overlap = min(len1, len2)
+
+    score = 0
+    for i in range(overlap):
+        score += score_matrix[seq1[i], seq2[i]]
+    if len1 != len2:
+        score += gap_open + gap_extend * (max(len1, len2) - overlap)
+    return score
+
+
+@njit(parallel=True, cache=True)
+def _batch_ungapped_scores(data1, offsets1, data2, offsets2,
+                           score_matrix, gap_open, gap_extend):
+    """Computes the ungapped lower-bound score for each pair of sequences,
+    stored as flat int8 buffers with offset arrays."""
+    # pylint: disable=too-many-arguments
+    num_pairs = offsets1.shape[0] - 1
+    scores = np.empty(num_pairs, dtype=np.int32)
+    # pylint: disable=not-an-iterable
+    for i in prange(num_pairs):
+        seq1 = data1[offsets1[i]:offsets1[i + 1]]
+        seq2 = data2[offsets2[i]:offsets2[i + 1]]
+        scores[i] = _ungapped_alignment_score(seq1, seq2, score_matrix,
+                                              gap_open, gap_extend)
+    return scores
+
+
+@njit(parallel=True, cache=True)
+def _batch_alignment_scores(data1, offsets1, data2, offsets2,
+                            score_matrix, gap_open, gap_extend):
+    """Computes the alignment score for each pair of sequences, where the
+    sequences are stored as flat int8 buffers with offset arrays."""
+    # pylint: disable=too-many-arguments
+    num_pairs = offsets1.shape[0] - 1
+    scores = np.empty(num_pairs, dtype=np.int32)
+    # pylint: disable=not-an-iterable
+    for i in prange(num_pairs):
+        seq1 = data1[offsets1[i]:offsets1[i + 1]]
+        seq2 = data2[offsets2[i]:offsets2[i + 1]]
+        scores[i] = _alignment_score(seq1, seq2, score_matrix,
+                                     gap_open, gap_extend)
+    return scores
+
+
+def pack_encoded_column(encoded):
+    """Packs a list of integer-encoded sequences (as produced by
+    encode_sequence) into a flat int8 buffer plus an array of offsets, ready
+    to pass to the numba alignment kernel."""
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = np.concatenate(encoded) if encoded else np.empty(0, dtype=np.int8)
+    return data, offsets
+
+
+def encode_sequence_column(sequences):
+    """Encodes an iterable of residue strings into a flat int8 buffer plus an
+    array of offsets, ready to pass to the numba alignment kernel."""
+    return pack_encoded_column([encode_sequence(seq) for seq in sequences])
+
+
+def calculate_alignment_scores_numba(column_1, column_2):
+    """Calculates the alignment score for each row, where the score is the
+    alignment between the element in the row in column_1 and the element in the
+    row at column_2.
+
+    Equivalent to calculate_alignment_scores, but computed in-process with a
+    numba JIT kernel parallelised over pairs instead of calling out to
+    seq-align for each pair."""
+    logging.info(f"Computing alignments between two columns of length "
+                 f"{len(column_1)} and {len(column_2)}")
+    data_1, offsets_1 = encode_sequence_column(column_1)
+    data_2, offsets_2 = encode_sequence_column(column_2)
+
+    scores = _batch_alignment_scores(data_1, offsets_1, data_2, offsets_2,
+                                     _BLOSUM62, GAP_OPEN, GAP_EXTEND)
+    logging.info(f"Alignments computed")
+    return scores
+
+
+def calculate_alignment_scores_encoded(column_1, column_2):
+    """As calculate_alignment_scores_numba, but the columns are lists of
+    already integer-encoded sequences (np.arrays produced by encode_sequence),
+    so no per-call string encoding is needed."""
+    logging.info(f"Computing alignments between two encoded columns of length "
+                 f"{len(column_1)} and {len(column_2)}")
+    data_1, offsets_1 = pack_encoded_column(column_1)
+    data_2, offsets_2 = pack_encoded_column(column_2)
+
+    scores = _batch_alignment_scores(data_1, offsets_1, data_2, offsets_2,
+                                     _BLOSUM62, GAP_OPEN, GAP_EXTEND)
+    logging.info(f"Alignments computed")
+    return scores
+
+
+def calculate_alignment_lower_bounds_encoded(column_1, column_2):
+    """Calculates a cheap lower bound on the alignment score for each pair of
+    integer-encoded sequences, by scoring the ungapped position-by-position
+    alignment. Any pair whose lower bound already reaches a threshold can
+    skip the full quadratic alignment."""
+    data_1, offsets_1 = pack_encoded_column(column_1)
+    data_2, offsets_2 = pack_encoded_column(column_2)
+
+    return _batch_ungapped_scores(data_1, offsets_1, data_2, offsets_2,
+                                  _BLOSUM62, GAP_OPEN, GAP_EXTEND)
 
 
 def calculate_alignment_score(seq1, seq2):
@@ -1,13 +1,29 @@
 """Interacts with biopython to find interactions within PDB files."""
+import base64
+import collections
+import concurrent.futures
+import functools
 import json
 import logging
+import multiprocessing
 import os
+import warnings
 
+import numpy as np
 import pandas as pd
+import scipy.spatial
 import Bio.PDB
 
 import peptidebinding.helper.utils as utils
 
+# Malformed records are common in the PDB files we process - the per-record
+#   construction warnings would otherwise dominate runtime on messy files
+warnings.filterwarnings('ignore',
+                        category=Bio.PDB.PDBExceptions.PDBConstructionWarning)
+
+# Single parser instance shared by all loading paths
+_PARSER = Bio.PDB.PDBParser(QUIET=True, PERMISSIVE=True)
+
 
 def save_structure_to_pdb(structure, filename):
     """Save a Biopython structure to a PDB file."""
@@ -21,59 +37,134 @@ def atom_is_ordered(atom):
     return not atom.is_disordered() or atom.get_altloc() == 'A'
 
 
+def _ordered_atoms_of(residue):
+    """Returns the ordered atoms of the given residue, caching the filtered
+    list on the residue object so the atom_is_ordered test runs once per atom
+    per structure rather than once per atom per fragment."""
+    # pylint: disable=protected-access
+    try:
+        return residue._ordered_atoms
+    except AttributeError:
+        ordered = [atom for atom in residue.get_unpacked_list()
+                   if atom_is_ordered(atom)]
+        residue._ordered_atoms = ordered
+        return ordered
+
+
+# Fixed-width record holding everything needed to find a residue again:
+#   chain id plus the (hetfield, sequence number, insertion code) id tuple
+_FULL_BP_ID_DTYPE = np.dtype([('chain', 'S4'), ('het', 'S8'),
+                              ('seq', '<i4'), ('icode', 'S1')])
+
+
 def get_full_bp_id_string(residues):
     """Take a list of Bio.PDB residue objects and return a string that contains
     all the information needed to retrieve these objects from the structure
-    using select_residues_from_bp_id_string."""
-    res_dicts = [{'chain': res.get_parent().get_id(), 'id': res.get_id()}
-                 for res in residues]
-
-    return json.dumps(res_dicts)
+    using select_residues_from_bp_id_string.
+
+    The chain and residue ids are packed into fixed-width records and
+    base64-encoded, which is far cheaper to write and parse than the JSON
+    encoding previously used. Ids too wide for the packed records fall back
+    to JSON, which the reader still accepts."""
+    records = []
+    for res in residues:
+        chain = res.get_parent().get_id()
+        het, seq, icode = res.get_id()
+        if len(chain) > 4 or len(het) > 8 or len(icode) > 1:
+            res_dicts = [{'chain': r.get_parent().get_id(), 'id': r.get_id()}
+                         for r in residues]
+            return json.dumps(res_dicts)
+        records.append((chain, het, seq, icode))
+
+    packed = np.array(records, dtype=_FULL_BP_ID_DTYPE)
+    return base64.b64encode(packed.tobytes()).decode('ascii')
 
 
 def select_residues_from_bp_id_string(bp_id_string, structure):
     """Given a loaded Bio.PDB structure, select the residues specified by the
-    string, which should have been produced by get_full_bp_id_string."""
-    res_dicts = json.loads(bp_id_string)
-
-    residues = [structure[0][res_dict['chain']].child_dict[tuple(res_dict['id'])]
+    string, which should have been produced by get_full_bp_id_string.
+    Strings from older csv files using the JSON encoding are also accepted."""
+    if bp_id_string.startswith('['):
+        res_dicts = json.loads(bp_id_string)
+        return [structure[0][res_dict['chain']].child_dict[tuple(res_dict['id'])]
                 for res_dict in res_dicts]
 
+    records = np.frombuffer(base64.b64decode(bp_id_string),
+                            dtype=_FULL_BP_ID_DTYPE)
+    residues = [structure[0][record['chain'].decode()]
+                .child_dict[(record['het'].decode(),
+                             int(record['seq']),
+                             record['icode'].decode())]
+                for record in records]
+
     return residues
 
 
-def get_compact_bp_id_string(residues):
+def build_residue_index(residues):
+    """Builds a dictionary mapping id(residue) -> position in the given list,
+    so that later lookups are O(1) instead of an O(N) list.index scan."""
+    return {id(res): ind for ind, res in enumerate(residues)}
+
+
+def _residues_of(model):
+    """Returns the list of residues in the given model and the reverse index
+    from build_residue_index, caching both on the model object so that
+    decoding many bp_id strings against the same structure only traverses the
+    entity tree once."""
+    # pylint: disable=protected-access
+    try:
+        return model._cached_residues, model._cached_res_index
+    except AttributeError:
+        residues = list(model.get_residues())
+        res_index = build_residue_index(residues)
+        model._cached_residues = residues
+        model._cached_res_index = res_index
+        return residues, res_index
+
+
+def get_compact_bp_id_string(residues, res_index=None):
     """Take a list of Bio.PDB residue objects and return a string that contains
     all the information needed to retrieve these objects from the structure
     using select_residues_from_compact_bp_id_string.
 
+    res_index may be a precomputed dictionary from build_residue_index over
+    all the residues in the structure; if it is omitted it is built here.
+
     Not as robust as get_full_bp_id_string as it assumes that the residues
     will be listed in the same order when we read in the PDB file again. This
     should be true, but no checks are made."""
     if residues:
-        all_residues = list(residues[0].get_parent().get_parent().get_residues())
-        indices = [all_residues.index(res) for res in residues]
+        if res_index is None:
+            model = residues[0].get_parent().get_parent()
+            unused_residues, res_index = _residues_of(model)
+        indices = [res_index[id(res)] for res in residues]
     else:
         indices = []
 
-    return json.dumps(indices)
+    return utils.encode_bp_indices(indices)
 
 
 def select_residues_from_compact_bp_id_string(bp_id_string, structure):
     """Given a loaded Bio.PDB structure, select the residues specified by the
-    string, which should have been produced by get_compact_bp_id_string."""
-    indices = json.loads(bp_id_string)
+    string, which should have been produced by get_compact_bp_id_string.
+    Strings from older csv files using the JSON encoding are also accepted."""
+    indices = utils.decode_bp_indices(bp_id_string)
 
-    all_residues = list(structure[0].get_residues())
+    all_residues, unused_res_index = _residues_of(structure[0])
     residues = [all_residues[ind] for ind in indices]
 
     return residues
 
 
-def sort_bp_residues(bp_residues, all_residues):
+def sort_bp_residues(bp_residues, all_residues, res_index=None):
     """Zips together the residues list with their indices in the full list of
-    residues and returns this list, sorted by the indices."""
-    bp_residue_indices = [all_residues.index(res) for res in bp_residues]
+    residues and returns this list, sorted by the indices.
+
+    res_index may be a precomputed dictionary from build_residue_index over
+    all_residues; if it is omitted it is built here."""
+    if res_index is None:
+        res_index = build_residue_index(all_residues)
+    bp_residue_indices = [res_index[id(res)] for res in bp_residues]
 
     zipped = zip(bp_residue_indices, bp_residues)
     sorted_residues_zipped = sorted(zipped, key=lambda pair: pair[0])
@@ -91,9 +182,15 @@ def get_bp_nbrs(residues, distance=1):
         structure[0]["A"].child_list[i]
         structure[0]["A"].child_list[i+1]"""
     res_nbrs = set()
+    chain_indices = {}
     for residue in residues:
-        chain_list = residue.get_parent().child_list
-        index = chain_list.index(residue)
+        chain = residue.get_parent()
+        chain_list = chain.child_list
+        # Index each chain's residues once, rather than a list.index scan
+        #   per residue
+        if id(chain) not in chain_indices:
+            chain_indices[id(chain)] = build_residue_index(chain_list)
+        index = chain_indices[id(chain)][id(residue)]
         min_index = max(0, index - distance)
         max_index = min(len(chain_list), index + distance + 1)
 
@@ -103,57 +200,136 @@ def get_bp_nbrs(residues, distance=1):
     return list(res_nbrs)
 
 
+# Search structure built over all the (ordered) atoms of a structure:
+#   tree is a scipy cKDTree over the atom coordinates, atom_list holds the
+#   corresponding Bio.PDB atom objects in the same order, atom_residue_idx
+#   maps each atom to the index of its residue in the structure's residue
+#   list and residues is that residue list. Keeping the per-atom data in
+#   flat arrays means query results can be turned into residues by integer
+#   gathers rather than walking back up the entity tree atom by atom.
+NeighborSearchContext = collections.namedtuple('NeighborSearchContext',
+                                               ['tree', 'atom_list',
+                                                'atom_residue_idx', 'residues'])
+
+# Up to this many atoms in the structure, contact detection uses one dense
+#   cdist call instead of a tree query - the distance matrix for a small CDR
+#   block against the whole structure is cheap and avoids per-query overhead
+CDIST_MAX_ATOMS = 50000
+
+# Minimum number of CDR-like fragments before find_all_binding_pairs spreads
+#   the per-fragment searches over a process pool - below this the pool
+#   start-up costs more than it saves
+PARALLEL_MIN_FRAGMENTS = 512
+
+
 def load_structure_for_search(pdb_id):
     """Loads structure using Biopython, extracts the list of residues and sets
     up the tree used to search for neighbouring atoms."""
     # Load the structure and label it with the pdb_id
-    structure = Bio.PDB.PDBParser().get_structure(pdb_id,
-                                                  utils.get_pdb_filename(pdb_id))
+    structure = _PARSER.get_structure(pdb_id, utils.get_pdb_filename(pdb_id))
     all_residues = list(structure.get_residues())
 
-    atom_list = [atom for atom in structure.get_atoms() if atom_is_ordered(atom)]
-    neighbor_search = Bio.PDB.NeighborSearch(atom_list)
+    atom_list = []
+    atom_residue_idx = []
+    for residue_ind, residue in enumerate(all_residues):
+        for atom in _ordered_atoms_of(residue):
+            atom_list.append(atom)
+            atom_residue_idx.append(residue_ind)
+    atom_residue_idx = np.array(atom_residue_idx)
 
-    return all_residues, neighbor_search
+    coords = np.vstack([atom.coord for atom in atom_list])
+    tree = scipy.spatial.cKDTree(coords)
 
+    return all_residues, NeighborSearchContext(tree, atom_list,
+                                               atom_residue_idx, all_residues)
 
-def construct_bound_pair_dict(pdb_id, cdr_residues, target_residues):
-    """Constructs a dictionary of the bound pair consisting of a CDR fragment
-    and its target. Many can be saved together in a csv file e.g. using
-    construct_database.print_targets_to_file."""
-    cdr_resnames = [Bio.PDB.protein_letters_3to1[res.get_resname()]
-                    for res in cdr_residues]
-    cdr_bp_ids_str = get_compact_bp_id_string(cdr_residues)
-
-    target_resnames = [Bio.PDB.protein_letters_3to1[res.get_resname()]
-                       for res in target_residues]
-    target_bp_ids_str = get_compact_bp_id_string(target_residues)
-
-    bound_pairs = {'pdb_id': pdb_id,
-                   'cdr_resnames': "".join(cdr_resnames),
-                   'cdr_bp_id_str': cdr_bp_ids_str,
-                   'target_length': len(target_residues),
-                   'target_resnames': "".join(target_resnames),
-                   'target_bp_id_str': target_bp_ids_str}
-    return bound_pairs
 
+@functools.lru_cache(maxsize=32)
+def _load_ids_resname_arr(pdb_id):
+    """Loads and caches the one-letter residue names listed in the IDs file
+    for the given PDB ID, as a flat array indexed by matrix index."""
+    ids_df = pd.read_csv(utils.get_id_filename(pdb_id),
+                         sep=" ",
+                         header=None)
+    return ids_df.iloc[:, 2].to_numpy(dtype='U1')
 
-def find_missing_residues(residue_1, residue_2):
-    """Returns a list of any residues that appear in the chain between these
-    two residues."""
-    chain_obj_1 = residue_1.get_parent()
-    chain_obj_2 = residue_2.get_parent()
-    assert chain_obj_1 == chain_obj_2,\
-        "Residues must be on the same chain"
 
-    min_index = chain_obj_1.child_list.index(residue_1) + 1
-    max_index = chain_obj_1.child_list.index(residue_2)
-    assert min_index < max_index,\
-        "residue_1 must come (strictly) earlier in the chain than residue_2"
+@functools.lru_cache(maxsize=32)
+def _load_pdb_context(pdb_id):
+    """Loads and caches everything find_all_binding_pairs needs for a PDB ID:
+    the residue list, the neighbor-search structure and the precomputed
+    residue index and name arrays. Repeated queries against the same PDB file
+    (e.g. for several fragment lengths) then skip the parse and the O(N log N)
+    tree build entirely."""
+    all_residues, neighbor_search = load_structure_for_search(pdb_id)
+    res_index = build_residue_index(all_residues)
+    resname_arr = build_resname_array(all_residues)
+
+    return all_residues, neighbor_search, res_index, resname_arr
+
+
+def build_resname_array(all_residues):
+    """Builds an array of the one-letter residue names of the given residues,
+    so that later names can be gathered by index instead of a dictionary
+    lookup per residue."""
+    return np.array([Bio.PDB.protein_letters_3to1[res.get_resname()]
+                     for res in all_residues],
+                    dtype='U1')
+
+
+# The fields describing each bound pair, in the order the csv columns are
+#   written
+BOUND_PAIR_FIELDS = ('pdb_id', 'cdr_resnames', 'cdr_bp_id_str',
+                     'target_length', 'target_resnames', 'target_bp_id_str')
+
+
+def new_bound_pair_columns():
+    """Returns an empty columnar accumulator for bound pairs: one list per
+    field in BOUND_PAIR_FIELDS. Can be saved to a csv file e.g. using
+    utils.print_targets_to_file once filled."""
+    return {field: [] for field in BOUND_PAIR_FIELDS}
+
+
+def extend_bound_pair_columns(columns, new_columns):
+    """Appends all the bound pairs in new_columns to columns, field by
+    field."""
+    for field in BOUND_PAIR_FIELDS:
+        columns[field].extend(new_columns[field])
+
+
+def append_bound_pair(columns, pdb_id, cdr_residues, target_residues, res_index=None,
+                      resname_arr=None):
+    """Appends the bound pair consisting of a CDR fragment and its target to
+    the given columnar accumulator (see new_bound_pair_columns). Appending
+    to flat per-field lists avoids building a Python dict per bound pair.
+
+    res_index may be a precomputed dictionary from build_residue_index and
+    resname_arr a precomputed array from build_resname_array, both over all
+    the residues in the structure."""
+    # pylint: disable=too-many-arguments
+    if resname_arr is not None and res_index is not None:
+        # Look up each residue's index once and reuse the index arrays both
+        #   for the resname gather and for the packed id strings
+        cdr_indices = [res_index[id(res)] for res in cdr_residues]
+        target_indices = [res_index[id(res)] for res in target_residues]
+        cdr_resnames = resname_arr[cdr_indices]
+        target_resnames = resname_arr[target_indices]
+        cdr_bp_ids_str = utils.encode_bp_indices(cdr_indices)
+        target_bp_ids_str = utils.encode_bp_indices(target_indices)
+    else:
+        cdr_resnames = [Bio.PDB.protein_letters_3to1[res.get_resname()]
+                        for res in cdr_residues]
+        target_resnames = [Bio.PDB.protein_letters_3to1[res.get_resname()]
+                           for res in target_residues]
+        cdr_bp_ids_str = get_compact_bp_id_string(cdr_residues, res_index)
+        target_bp_ids_str = get_compact_bp_id_string(target_residues, res_index)
 
-    missing_residues = [chain_obj_1.child_list[ind]
-                        for ind in range(min_index, max_index)]
-    return missing_residues
+    columns['pdb_id'].append(pdb_id)
+    columns['cdr_resnames'].append("".join(cdr_resnames))
+    columns['cdr_bp_id_str'].append(cdr_bp_ids_str)
+    columns['target_length'].append(len(target_residues))
+    columns['target_resnames'].append("".join(target_resnames))
+    columns['target_bp_id_str'].append(target_bp_ids_str)
 
 
 def find_all_binding_pairs(matrix, pdb_id, fragment_length):
@@ -168,12 +344,12 @@ def find_all_binding_pairs(matrix, pdb_id, fragment_length):
         fragment_length (int): length of desired interacting pairs
 
     Returns:
-        array[array[array]]: Each array corresponds to a binding pair and
-            contains two arrays: the first is an array of indices in the
-            CDR-like fragment and the second is an array of indices that
-            interact with those indices.
-            The CDR-like fragment will have length precisely
-            fragment_length, but the target indices may not be this length.
+        dict: columnar accumulator (see new_bound_pair_columns) with one row
+            per binding pair, describing the whole CDR fragment and the whole
+            interacting region. The CDR-like fragment will have length
+            precisely fragment_length, but the target may not be this length.
+        dict: columnar accumulator as above, but with one row per contiguous
+            fragment of each interacting region.
 
     The interaction matrix tells us which fragments are CDR-like and also which
     residues interact. If M_{x,y} is negative then the residue x interacts with
@@ -184,47 +360,93 @@ def find_all_binding_pairs(matrix, pdb_id, fragment_length):
     We ignore the interactions described in the matrix, and instead use the PDB
     file to find interactions.
     """
+    # pylint: disable=too-many-locals
     assert matrix.shape[0] == matrix.shape[1],\
         "Matrix is assumed to be square"
 
     matrix_size = matrix.shape[0]
 
-    # Read in IDs file to get pdb indices of these indices
-    ids_df = pd.read_csv(utils.get_id_filename(pdb_id),
-                         sep=" ",
-                         header=None)
+    # Read in IDs file to get the one-letter residue names it lists, as a
+    #   flat array indexed by matrix index
+    ids_resname_arr = _load_ids_resname_arr(pdb_id)
 
-    all_residues, neighbor_search = load_structure_for_search(pdb_id)
+    all_residues, neighbor_search, res_index, resname_arr = _load_pdb_context(pdb_id)
 
     assert matrix_size == len(all_residues),\
         "Biopython should return the same number of residues as are listed by the matrix"
 
-    all_bound_pairs = []
-    all_bound_pairs_fragmented = []
-
-    for start_index in range(0, matrix_size - fragment_length):
+    all_bound_pairs = new_bound_pair_columns()
+    all_bound_pairs_fragmented = new_bound_pair_columns()
+
+    # The entries deciding whether each fragment is CDR-like i.e. has been
+    #   observed in a CDR all lie on one diagonal of the matrix, so extract it
+    #   once and find the hits with a single vectorized comparison rather than
+    #   reading and branching on one element per candidate start position
+    diagonal = np.diagonal(matrix, offset=fragment_length - 1)
+    diagonal = diagonal[:matrix_size - fragment_length]
+    hit_starts = np.flatnonzero((diagonal > 0) | (diagonal < -1))
+
+    if len(hit_starts) >= PARALLEL_MIN_FRAGMENTS and os.cpu_count() > 1:
+        # Each fragment's search is independent and the structure is
+        #   read-only, so farm the hits out to a process pool. Workers load
+        #   the cached per-PDB context once per process; results come back in
+        #   order so the output matches the serial path exactly. Spawn rather
+        #   than fork - forking after numba's threaded kernels have run
+        #   leaves workers wedged on inherited thread state
+        tasks = [(pdb_id, int(start_index), fragment_length)
+                 for start_index in hit_starts]
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = executor.map(_find_targets_task, tasks, chunksize=16)
+            for bound_pair, bound_pairs_fragmented in results:
+                extend_bound_pair_columns(all_bound_pairs, bound_pair)
+                extend_bound_pair_columns(all_bound_pairs_fragmented,
+                                          bound_pairs_fragmented)
+
+        return all_bound_pairs, all_bound_pairs_fragmented
+
+    for start_index in hit_starts:
         end_index = start_index + fragment_length - 1
-        matrix_entry = matrix[start_index][end_index]
-
-        # First check if this fragment is a CDR-like fragment i.e. has it been
-        #    observed in a CDR.
-        if matrix_entry > 0 or matrix_entry < -1:
-            # Get the indices belonging to this fragment - note range() excludes
-            #   second number given
-            cdr_indices = list(range(start_index, end_index + 1))
-            bound_pair, bound_pairs_fragmented = find_targets_from_pdb(pdb_id,
-                                                                       cdr_indices,
-                                                                       ids_df,
-                                                                       neighbor_search,
-                                                                       all_residues)
-
-            all_bound_pairs.extend(bound_pair)
-            all_bound_pairs_fragmented.extend(bound_pairs_fragmented)
+
+        # Get the indices belonging to this fragment - note range() excludes
+        #   second number given
+        cdr_indices = list(range(start_index, end_index + 1))
+        bound_pair, bound_pairs_fragmented = find_targets_from_pdb(pdb_id,
+                                                                   cdr_indices,
+                                                                   ids_resname_arr,
+                                                                   neighbor_search,
+                                                                   all_residues,
+                                                                   res_index,
+                                                                   resname_arr)
+
+        extend_bound_pair_columns(all_bound_pairs, bound_pair)
+        extend_bound_pair_columns(all_bound_pairs_fragmented,
+                                  bound_pairs_fragmented)
 
     return all_bound_pairs, all_bound_pairs_fragmented
 
 
-def find_targets_from_pdb(pdb_id, cdr_indices, ids_df, neighbor_search, all_residues):
+def _find_targets_task(task):
+    """Worker for the parallel branch of find_all_binding_pairs: finds the
+    targets of one CDR-like fragment, loading the cached per-PDB context in
+    the worker process."""
+    pdb_id, start_index, fragment_length = task
+    all_residues, neighbor_search, res_index, resname_arr = _load_pdb_context(pdb_id)
+    ids_resname_arr = _load_ids_resname_arr(pdb_id)
+
+    cdr_indices = list(range(start_index, start_index + fragment_length))
+    return find_targets_from_pdb(pdb_id,
+                                 cdr_indices,
+                                 ids_resname_arr,
+                                 neighbor_search,
+                                 all_residues,
+                                 res_index,
+                                 resname_arr)
+
+
+def find_targets_from_pdb(pdb_id, cdr_indices, ids_resname_arr, neighbor_search,
+                          all_residues, res_index=None, resname_arr=None):
     """
     Finds target fragments of a given CDR.
 
@@ -232,49 +454,63 @@ def find_targets_from_pdb(pdb_id, cdr_indices, ids_df, neighbor_search, all_resi
         pdb_id (string): ID of PDB file e.g. '2zxx'
         cdr_indices (array): array of integer indices to the
             interaction matrix
-        ids_df (pd.DataFrame): data frame indexed by the indices
-            for the interaction matrix, with columns
-                chain, pdb_index, one-letter amino acid code
-        neighbor_search (Bio.PDB.NeighborSearch): object that allows fast
-            neighbor searching - can be set up using load_structure_for_search
+        ids_resname_arr (np.array): array of one-letter amino acid codes from
+            the IDs file, indexed by the indices for the interaction matrix
+        neighbor_search (NeighborSearchContext): tree and atom list that
+            allow fast neighbor searching - can be set up using
+            load_structure_for_search
         all_residues (array): array of all the Bio.PDB.Residue objects that are
             in the structure for this PDB file
+        res_index (dict): dictionary from build_residue_index over all_residues,
+            allowing O(1) lookup of a residue's position; built here if omitted
+        resname_arr (np.array): array from build_resname_array over all_residues,
+            giving each residue's one-letter name; built here if omitted
 
     Returns:
-        array: (array of dicts, usually 1), each containing information about
-            the whole CDR fragment and the whole interacting region
-        array: (array of dicts, usually many), each containing information about
-            the whole CDR fragment and an interacting fragment
+        dict: columnar accumulator (see new_bound_pair_columns) describing the
+            whole CDR fragment and the whole interacting region (usually 1 row)
+        dict: columnar accumulator describing the whole CDR fragment and each
+            interacting fragment (usually many rows)
     """
-    cdr_resnames_from_ids = [ids_df.loc[index, 2] for index in cdr_indices]
+    # pylint: disable=too-many-arguments
+    if res_index is None:
+        res_index = build_residue_index(all_residues)
+    if resname_arr is None:
+        resname_arr = build_resname_array(all_residues)
 
     cdr_residues_from_bp = [all_residues[index] for index in cdr_indices]
-    cdr_resnames_from_bp = [Bio.PDB.protein_letters_3to1[res.get_resname()]
-                            for res in cdr_residues_from_bp]
 
-    assert cdr_resnames_from_bp == list(cdr_resnames_from_ids),\
+    assert np.array_equal(resname_arr[cdr_indices], ids_resname_arr[cdr_indices]),\
         f"Error in PDB file {pdb_id}. Residue names from ids list and " \
         "Biopython parser should match."
 
-    bound_pairs = []
-    bound_pairs_fragmented = []
+    bound_pairs = new_bound_pair_columns()
+    bound_pairs_fragmented = new_bound_pair_columns()
 
     nearby_residues = find_contacting_residues_pdb(cdr_residues_from_bp,
                                                    neighbor_search)
 
     if nearby_residues:
         sorted_nearby_residues, sorted_nearby_residues_z = sort_bp_residues(nearby_residues,
-                                                                            all_residues)
-        bound_pairs.append(construct_bound_pair_dict(pdb_id,
-                                                     cdr_residues_from_bp,
-                                                     sorted_nearby_residues))
-
-        targets_fragmented = find_contiguous_fragments(sorted_nearby_residues_z)
+                                                                            all_residues,
+                                                                            res_index)
+        append_bound_pair(bound_pairs,
+                          pdb_id,
+                          cdr_residues_from_bp,
+                          sorted_nearby_residues,
+                          res_index,
+                          resname_arr)
+
+        targets_fragmented = find_contiguous_fragments(sorted_nearby_residues_z,
+                                                       all_residues=all_residues)
 
         for fragment in targets_fragmented:
-            bound_pairs_fragmented.append(construct_bound_pair_dict(pdb_id,
-                                                                    cdr_residues_from_bp,
-                                                                    fragment))
+            append_bound_pair(bound_pairs_fragmented,
+                              pdb_id,
+                              cdr_residues_from_bp,
+                              fragment,
+                              res_index,
+                              resname_arr)
 
     return bound_pairs, bound_pairs_fragmented
 
@@ -286,8 +522,9 @@ def find_contacting_residues_pdb(cdr_residues, neighbor_search):
 
     Args:
         cdr_residues (array): array of Bio.PDB.Residue objects
-        neighbor_search (Bio.PDB.NeighborSearch): object that allows fast
-            neighbor searching - can be set up using load_structure_for_search
+        neighbor_search (NeighborSearchContext): tree and atom list that
+            allow fast neighbor searching - can be set up using
+            load_structure_for_search
 
     Returns:
         array: array containing Bio.PDB.Residue objects corresponding to the residues
@@ -300,29 +537,54 @@ def find_contacting_residues_pdb(cdr_residues, neighbor_search):
     #   therefore just remove the disordered atoms to be sure we are left with a
     #   single location for each residue.
 
-    # Get only ordered atoms of CDR
+    # Get only ordered atoms of CDR, pre-filtered once per residue at
+    #   structure load and cached on the residue
     cdr_atoms = [atom
-                 for atom in Bio.PDB.Selection.unfold_entities(cdr_residues, 'A')
-                 if atom_is_ordered(atom)]
-
-    # Find ordered atoms which are neighbours of these atoms (within 3.5 Angstroms)
-    radius = 3.5
-    nearby_atoms = {atom for cdr_atom in cdr_atoms
-                    for atom in neighbor_search.search(cdr_atom.coord, radius, 'A')
-                    if atom_is_ordered(atom)}
+                 for res in cdr_residues
+                 for atom in _ordered_atoms_of(res)]
 
-    # Find residues these atoms belong to
-    nearby_residues = {atom.get_parent() for atom in nearby_atoms}
+    # If every atom was disordered with a non-'A' altloc there is nothing to
+    #   query - neither search path accepts an empty coordinate array
+    if not cdr_atoms:
+        return []
 
-    extended_cdr = get_bp_nbrs(cdr_residues)
-    cleaned_residues = [res
-                        for res in nearby_residues
-                        if res not in extended_cdr]
+    # Find atoms which are neighbours of these atoms (within 3.5 Angstroms) -
+    #   the search structure only contains ordered atoms
+    radius = 3.5
+    cdr_coords = np.array([atom.coord for atom in cdr_atoms])
+    if len(neighbor_search.atom_list) <= CDIST_MAX_ATOMS:
+        # For moderate structures a dense distance matrix in one cdist call
+        #   is faster than a tree query, since it runs entirely in C. Compare
+        #   squared distances to avoid the sqrt.
+        squared_distances = scipy.spatial.distance.cdist(cdr_coords,
+                                                         neighbor_search.tree.data,
+                                                         'sqeuclidean')
+        mask = (squared_distances <= radius ** 2).any(axis=0)
+        nearby_atom_indices = np.flatnonzero(mask)
+    else:
+        # Unsorted results are cheaper and order is irrelevant here; workers
+        #   spreads the per-point queries over all cores
+        index_lists = neighbor_search.tree.query_ball_point(cdr_coords, radius,
+                                                            workers=-1,
+                                                            return_sorted=False)
+        nearby_atom_indices = np.unique(np.concatenate(index_lists)).astype(int) \
+            if any(index_lists) else np.array([], dtype=int)
+
+    # Find residues these atoms belong to by gathering their residue indices
+    residue_indices = np.unique(neighbor_search.atom_residue_idx[nearby_atom_indices])
+
+    # Drop the CDR itself and its immediate chain neighbours, testing object
+    #   identity against a set rather than Python equality against a list
+    excluded_ids = {id(res) for res in get_bp_nbrs(cdr_residues)}
+    cleaned_residues = [neighbor_search.residues[index]
+                        for index in residue_indices
+                        if id(neighbor_search.residues[index]) not in excluded_ids]
 
     return cleaned_residues
 
 
-def find_contiguous_fragments(residues_z, max_gap=1, min_fragment_length=3):
+def find_contiguous_fragments(residues_z, max_gap=1, min_fragment_length=3,
+                              all_residues=None):
     """
     Splits a list of residues into contiguous fragments.
 
@@ -337,6 +599,10 @@ def find_contiguous_fragments(residues_z, max_gap=1, min_fragment_length=3):
         min_fragment_length (int): Minimum number of residues in a fragment
             before it is counted as a fragment. E.g. with min_fragment_length=3
             any fragments shorter than 3 would be discarded.
+        all_residues (array): optional list of all the residues in the
+            structure, in the order their indices refer to. If given, gaps
+            are filled by slicing this list directly; otherwise the residues
+            are recovered from the relevant chain.
 
     Returns:
         array: array of arrays. Each array corresponds to a contiguous fragment, and
@@ -355,50 +621,86 @@ def find_contiguous_fragments(residues_z, max_gap=1, min_fragment_length=3):
     fragments = []
 
     if residues_z:
-        # Build up each fragment element by element, starting a new fragment
-        #   when the next element isn't compatible with the current fragment
-        #   either because there is too big a gap between residue numbers or
-        #   because they are on separate chains
-        # Recall that the list residues_z contains pairs (index, residue_obj)
-        current_index = residues_z[0][0]
-        current_residue = residues_z[0][1]
-        current_chain_obj = current_residue.get_parent()
-
-        working_fragment = [residues_z[0][1]]
-        for target in residues_z[1:]:
-            new_index = target[0]
-            new_residue = target[1]
-            new_chain_obj = new_residue.get_parent()
-
-            if new_chain_obj == current_chain_obj:
-                assert new_index > current_index, \
-                    "List of indices must be sorted {} {}".format(new_index, current_index)
-
-            gap = (new_index - current_index) - 1
-            # If the gap is bigger than allowed or the chain has changed
-            #   then we must start a new fragment
-            if new_chain_obj != current_chain_obj or gap > max_gap:
-                # Add the completed fragment to the list of fragments if it is long enough
-                if len(working_fragment) >= min_fragment_length:
-                    fragments.append(working_fragment)
-                # Start a new fragment
-                working_fragment = [new_residue]
+        # Recall that the list residues_z contains pairs (index, residue_obj).
+        #   Pull the indices and chain identities out into flat arrays so
+        #   fragment boundaries can be found with one vectorized comparison
+        #   rather than attribute chasing per residue in a Python loop
+        indices = np.array([index for index, residue in residues_z])
+        residues = [residue for index, residue in residues_z]
+        chain_ids = np.array([id(residue.get_parent()) for residue in residues])
+
+        same_chain = chain_ids[1:] == chain_ids[:-1]
+        gaps = np.diff(indices) - 1
+        assert np.all(gaps[same_chain] >= 0),\
+            "List of indices must be sorted"
+
+        # A fragment ends wherever the chain changes or the gap between
+        #   consecutive residues is bigger than allowed
+        breaks = np.flatnonzero(~same_chain | (gaps > max_gap)) + 1
+
+        for segment in np.split(np.arange(len(residues)), breaks):
+            start, end = segment[0], segment[-1]
+            filled_length = indices[end] - indices[start] + 1
+            if filled_length < min_fragment_length:
+                continue
+
+            if filled_length == len(segment):
+                fragment = [residues[position] for position in segment]
+            elif all_residues is not None:
+                # The indices are positions in all_residues, so the filled
+                #   fragment is just a slice of it - no chain scans at all
+                fragment = all_residues[indices[start]:indices[end] + 1]
             else:
-                if gap:
-                    # Select the residues strictly between these two indices
-                    working_fragment.extend(find_missing_residues(current_residue,
-                                                                  new_residue))
+                # Fill the gaps from the chain's residue list - the whole
+                #   segment lies on one chain, so the chain positions are the
+                #   global indices shifted by a constant offset
+                chain_list = residues[start].get_parent().child_list
+                offset = indices[start] - chain_list.index(residues[start])
+                fragment = chain_list[indices[start] - offset:
+                                      indices[end] - offset + 1]
+            fragments.append(fragment)
 
-                working_fragment.append(new_residue)
+    return fragments
 
-            current_chain_obj = new_chain_obj
-            current_index = new_index
-            current_residue = new_residue
 
-        if len(working_fragment) >= min_fragment_length:
-            fragments.append(working_fragment)
+def _write_fragment(pdb_file, chain_id, residues, serial):
+    """Writes the atoms of the given residues as ATOM records on the given
+    chain, followed by a TER record. Returns the next free serial number."""
+    for res in residues:
+        _, resseq, icode = res.get_id()
+        resname = res.get_resname()
+        for atom in res.get_unpacked_list():
+            x, y, z = atom.get_coord()
+            # Occupancy and bfactor may be None on malformed records - leave
+            #   the fields blank in that case, as Bio.PDB's writer does
+            occupancy = atom.get_occupancy()
+            occupancy_str = f"{occupancy:6.2f}" if occupancy is not None else " " * 6
+            bfactor = atom.get_bfactor()
+            bfactor_str = f"{bfactor:6.2f}" if bfactor is not None else " " * 6
+            pdb_file.write(f"ATOM  {serial:>5d} {atom.get_fullname():<4s}"
+                           f"{atom.get_altloc():1s}{resname:>3s} "
+                           f"{chain_id:1s}{resseq:>4d}{icode:1s}   "
+                           f"{x:8.3f}{y:8.3f}{z:8.3f}"
+                           f"{occupancy_str}{bfactor_str}"
+                           f"          {atom.element:>2s}\n")
+            serial += 1
 
-    return fragments
+    if residues:
+        last_res = residues[-1]
+        _, resseq, icode = last_res.get_id()
+        pdb_file.write(f"TER   {serial:>5d}      {last_res.get_resname():>3s} "
+                       f"{chain_id:1s}{resseq:>4d}{icode:1s}\n")
+        serial += 1
+
+    return serial
+
+
+@functools.lru_cache(maxsize=128)
+def _load_structure(pdb_id):
+    """Loads and caches the Bio.PDB structure for the given PDB ID, so the
+    same file is only parsed once even if it appears in many rows. Callers
+    must not modify the returned structure - copy residues before mutating."""
+    return _PARSER.get_structure(pdb_id, utils.get_pdb_filename(pdb_id))
 
 
 def write_bound_pair_to_pdb(row, filename):
@@ -418,13 +720,11 @@ def write_bound_pair_to_pdb(row, filename):
 
     The file will have a name that uniquely identifies the bound pair, given by
     utils.get_bound_pair_id_from_row"""
-    cdr_struct = Bio.PDB.PDBParser().get_structure(row['cdr_pdb_id'],
-                                                   utils.get_pdb_filename(row['cdr_pdb_id']))
+    cdr_struct = _load_structure(row['cdr_pdb_id'])
     cdr = select_residues_from_compact_bp_id_string(row['cdr_bp_id_str'],
                                                     cdr_struct)
 
-    target_struct = Bio.PDB.PDBParser().get_structure(row['target_pdb_id'],
-                                                      utils.get_pdb_filename(row['target_pdb_id']))
+    target_struct = _load_structure(row['target_pdb_id'])
     target = select_residues_from_compact_bp_id_string(row['target_bp_id_str'],
                                                        target_struct)
 
@@ -433,6 +733,10 @@ def write_bound_pair_to_pdb(row, filename):
         original_cdr = select_residues_from_compact_bp_id_string(row['original_cdr_bp_id_str'],
                                                                  target_struct)
 
+        # Copy the CDR residues so the superposition doesn't mutate the
+        #   cached structure
+        cdr = [res.copy() for res in cdr]
+
         sup = Bio.PDB.Superimposer()
         fixed = [res['CA'] for res in original_cdr]
         moving = [res['CA'] for res in cdr]
@@ -440,44 +744,54 @@ def write_bound_pair_to_pdb(row, filename):
         for res in cdr:
             sup.apply(res)
 
-    # Construct a structure containing all the residues to be saved
-    s = Bio.PDB.Structure.Structure('pair')
-    m = Bio.PDB.Model.Model(0)
-    s.add(m)
-    cdr_chain = Bio.PDB.Chain.Chain('C')
-    target_chain = Bio.PDB.Chain.Chain('T')
-
-    for res in cdr:
-        cdr_chain.add(res)
-
-    for res in target:
-        target_chain.add(res)
+    # Write the ATOM records directly - for fragments this small, building a
+    #   Structure/Model/Chain hierarchy just to run Bio.PDB's writer costs
+    #   more than the formatting itself
+    with open(filename, 'w') as pdb_file:
+        serial = 1
+        serial = _write_fragment(pdb_file, 'C', cdr, serial)
+        _write_fragment(pdb_file, 'T', target, serial)
+        pdb_file.write("END\n")
 
-    m.add(cdr_chain)
-    m.add(target_chain)
 
-    # Save the structure
-    save_structure_to_pdb(s, filename)
+def _write_bound_pair_task(task):
+    """Helper for write_all_bound_pairs_pdb - unpacks a (row_dict, filename)
+    pair so the work can be distributed through an executor map."""
+    row, filename = task
+    write_bound_pair_to_pdb(row, filename)
 
 
 def write_all_bound_pairs_pdb(bound_pairs_df):
     """Write every row in the data frame to a PDB file, as in write_bound_pair_to_pdb.
-    Returns a list of all the files written."""
+    Rows are written in parallel across processes. Returns a list of all the
+    files written."""
     filenames = []
-    generated = 0
-    for _ind, row in bound_pairs_df.iterrows():
-        bound_pair_id = utils.get_bound_pair_id_from_row(row)
+    tasks = []
+    for row in bound_pairs_df.itertuples(index=False):
+        row_dict = row._asdict()  # pylint: disable=protected-access
+        bound_pair_id = utils.get_bound_pair_id_from_row(row_dict)
         filename = f"processed/pdbs/{bound_pair_id}.pdb"
         if os.path.exists(filename) and os.path.getsize(filename) > 0:
             logging.debug(f"PDB file '{filename}' already exists, skipping this bound pair.")
         else:
-            write_bound_pair_to_pdb(row, filename)
-            generated += 1
+            tasks.append((row_dict, filename))
         filenames.append(filename)
 
-        if len(filenames) % 100 == 0:
-            logging.info(f"Saved {len(filenames)} PDB files so far, last was {filename}. "
-                         f"{generated} have been generated in this run, "
-                         f"{len(filenames) - generated} were already present.")
+    logging.info(f"Will write {len(tasks)} PDB files, "
+                 f"{len(filenames) - len(tasks)} were already present.")
+
+    if tasks:
+        # Spawn rather than fork - forking after numba's threaded kernels
+        #   have run leaves workers wedged on inherited thread state, hanging
+        #   the interpreter at pool shutdown
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            # Consume the map so any exceptions from workers are raised here
+            list(executor.map(_write_bound_pair_task, tasks, chunksize=16))
+
+    logging.info(f"Saved {len(filenames)} PDB files. "
+                 f"{len(tasks)} have been generated in this run, "
+                 f"{len(filenames) - len(tasks)} were already present.")
 
     return filenames
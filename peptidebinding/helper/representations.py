@@ -4,7 +4,6 @@ https://github.com/eliberis/parapred/blob/d13600a3d5697ebd5796576e1d6166aa1a5199
 https://github.com/eliberis/parapred/blob/d13600a3d5697ebd5796576e1d6166aa1a519933/parapred/structure_processor.py"""
 import numpy as np
 import scipy.sparse
-import tensorflow as tf
 
 ################################################################################
 #   Utility functions                                                          #
@@ -12,39 +11,54 @@ import tensorflow as tf
 
 residues_order = "CSTPAGNDEQHRKMILVFYWX"  # X for unknown
 
+# Lookup table from character code to position in residues_order, so that
+#   converting a string is a single vectorized gather rather than a
+#   residues_order.index call per character. Unknown characters map to 'X'.
+_RESIDUE_LUT = np.full(256, residues_order.index('X'), dtype=np.int8)
+for _i, _c in enumerate(residues_order):
+    _RESIDUE_LUT[ord(_c)] = _i
+
+
 def resnames_to_ints(res_str):
     """Converts a string of residues e.g. 'AFFG' to an array of integers, using
     the global variable residues_order to give the order."""
-    return [residues_order.index(r) for r in res_str]
+    return _RESIDUE_LUT[np.frombuffer(res_str.encode('ascii'), np.uint8)]
+
 
+# Identity matrix used to build one-hot representations by fancy indexing
+_EYE = np.eye(len(residues_order), dtype=np.int8)
 
+
+# Meiler's features for each amino acid, with the order as in residues_order
 # pylint: disable=bad-whitespace
+_MEILER = np.array([[1.77, 0.13, 2.43,  1.54,  6.35, 0.17, 0.41],
+                    [1.31, 0.06, 1.60, -0.04,  5.70, 0.20, 0.28],
+                    [3.03, 0.11, 2.60,  0.26,  5.60, 0.21, 0.36],
+                    [2.67, 0.00, 2.72,  0.72,  6.80, 0.13, 0.34],
+                    [1.28, 0.05, 1.00,  0.31,  6.11, 0.42, 0.23],
+                    [0.00, 0.00, 0.00,  0.00,  6.07, 0.13, 0.15],
+                    [1.60, 0.13, 2.95, -0.60,  6.52, 0.21, 0.22],
+                    [1.60, 0.11, 2.78, -0.77,  2.95, 0.25, 0.20],
+                    [1.56, 0.15, 3.78, -0.64,  3.09, 0.42, 0.21],
+                    [1.56, 0.18, 3.95, -0.22,  5.65, 0.36, 0.25],
+                    [2.99, 0.23, 4.66,  0.13,  7.69, 0.27, 0.30],
+                    [2.34, 0.29, 6.13, -1.01, 10.74, 0.36, 0.25],
+                    [1.89, 0.22, 4.77, -0.99,  9.99, 0.32, 0.27],
+                    [2.35, 0.22, 4.43,  1.23,  5.71, 0.38, 0.32],
+                    [4.19, 0.19, 4.00,  1.80,  6.04, 0.30, 0.45],
+                    [2.59, 0.19, 4.00,  1.70,  6.04, 0.39, 0.31],
+                    [3.67, 0.14, 3.00,  1.22,  6.02, 0.27, 0.49],
+                    [2.94, 0.29, 5.89,  1.79,  5.67, 0.30, 0.38],
+                    [2.94, 0.30, 6.47,  0.96,  5.66, 0.25, 0.41],
+                    [3.21, 0.41, 8.08,  2.25,  5.94, 0.32, 0.42],
+                    [0.00, 0.00, 0.00,  0.00,  0.00, 0.00, 0.00]],
+                    dtype=np.float32)
+
+
 def residue_features():
     """Returns a np.array with the Meiler criteria for each amino acid, with
     the order as in residues_order."""
-    # Meiler's features
-    prop1 = [[1.77, 0.13, 2.43,  1.54,  6.35, 0.17, 0.41],
-             [1.31, 0.06, 1.60, -0.04,  5.70, 0.20, 0.28],
-             [3.03, 0.11, 2.60,  0.26,  5.60, 0.21, 0.36],
-             [2.67, 0.00, 2.72,  0.72,  6.80, 0.13, 0.34],
-             [1.28, 0.05, 1.00,  0.31,  6.11, 0.42, 0.23],
-             [0.00, 0.00, 0.00,  0.00,  6.07, 0.13, 0.15],
-             [1.60, 0.13, 2.95, -0.60,  6.52, 0.21, 0.22],
-             [1.60, 0.11, 2.78, -0.77,  2.95, 0.25, 0.20],
-             [1.56, 0.15, 3.78, -0.64,  3.09, 0.42, 0.21],
-             [1.56, 0.18, 3.95, -0.22,  5.65, 0.36, 0.25],
-             [2.99, 0.23, 4.66,  0.13,  7.69, 0.27, 0.30],
-             [2.34, 0.29, 6.13, -1.01, 10.74, 0.36, 0.25],
-             [1.89, 0.22, 4.77, -0.99,  9.99, 0.32, 0.27],
-             [2.35, 0.22, 4.43,  1.23,  5.71, 0.38, 0.32],
-             [4.19, 0.19, 4.00,  1.80,  6.04, 0.30, 0.45],
-             [2.59, 0.19, 4.00,  1.70,  6.04, 0.39, 0.31],
-             [3.67, 0.14, 3.00,  1.22,  6.02, 0.27, 0.49],
-             [2.94, 0.29, 5.89,  1.79,  5.67, 0.30, 0.38],
-             [2.94, 0.30, 6.47,  0.96,  5.66, 0.25, 0.41],
-             [3.21, 0.41, 8.08,  2.25,  5.94, 0.32, 0.42],
-             [0.00, 0.00, 0.00,  0.00,  0.00, 0.00, 0.00]]
-    return np.array(prop1)
+    return _MEILER
 
 ################################################################################
 #   Functions to generate flat arrays of features from raw information         #
@@ -56,17 +70,15 @@ def raw_onehot(resnames):
     the residue type.
 
     Returns an array where each row is one amino acid, and each column is a feature."""
-    ints = resnames_to_ints(resnames)
-    onehot = tf.keras.utils.to_categorical(ints, num_classes=len(residues_order))
-    return onehot
+    return _EYE[resnames_to_ints(resnames)]
 
 
 def raw_bagofwords(resnames):
     """Generates the bag of words representation of a string of residues. Each value
     represents the number of occurrences of that amino acid in the string."""
-    onehot = raw_onehot(resnames)
+    counts = np.bincount(resnames_to_ints(resnames), minlength=len(residues_order))
 
-    return onehot.sum(axis=0).astype('int8')
+    return counts.astype('int8')
 
 
 def raw_crossed_bagofwords(cdr_resnames, target_resnames):
@@ -77,7 +89,9 @@ def raw_crossed_bagofwords(cdr_resnames, target_resnames):
     cdr_bagofwords = raw_bagofwords(cdr_resnames)
     target_bagofwords = raw_bagofwords(target_resnames)
 
-    return np.outer(cdr_bagofwords, target_bagofwords).flatten().astype('int8')
+    # The int8 bag of words vectors multiply directly into an int8 matrix,
+    #   so no flatten-and-cast copy is needed
+    return np.multiply.outer(cdr_bagofwords, target_bagofwords).ravel()
 
 
 def raw_meiler(resnames):
@@ -86,7 +100,7 @@ def raw_meiler(resnames):
 
     Returns an array where each row is one amino acid, and each column is a feature."""
     ints = resnames_to_ints(resnames)
-    meiler = residue_features()[ints]
+    meiler = _MEILER[ints]
 
     return meiler
 
@@ -97,10 +111,15 @@ def raw_onehot_meiler(resnames):
     the residue type and the final 7 give the Meiler criteria for that residue.
 
     Returns an array where each row is one amino acid, and each column is a feature."""
-    meiler = raw_meiler(resnames)
-    onehot = raw_onehot(resnames)
+    ints = resnames_to_ints(resnames)
+
+    # Fill both halves of a single preallocated buffer rather than building
+    #   the one-hot and Meiler arrays separately and concatenating
+    combined = np.zeros((len(ints), len(residues_order) + 7), dtype=np.float32)
+    combined[np.arange(len(ints)), ints] = 1.0
+    combined[:, len(residues_order):] = _MEILER[ints]
 
-    return np.concatenate((onehot, meiler), axis=1)
+    return combined
 
 
 def raw_padded_onehot_meiler(resnames, max_length):
@@ -111,9 +130,13 @@ def raw_padded_onehot_meiler(resnames, max_length):
     which are just padding."""
     num_features = len(residues_order) + 7  # one-hot + extra features
 
-    cdr_mat = raw_onehot_meiler(resnames)
+    ints = resnames_to_ints(resnames)
+
+    # Write straight into the padded buffer rather than building the unpadded
+    #   representation first and copying it in
     cdr_mat_pad = np.zeros((max_length, num_features), dtype=np.float32)
-    cdr_mat_pad[:cdr_mat.shape[0], :] = cdr_mat
+    cdr_mat_pad[np.arange(len(ints)), ints] = 1.0
+    cdr_mat_pad[:len(ints), len(residues_order):] = _MEILER[ints]
 
     cdr_mask = np.zeros((max_length, 1), dtype=int)
     cdr_mask[:len(resnames), 0] = 1
@@ -172,10 +195,14 @@ def generate_representation_all(bound_pairs_df, generate_func):
     Can give arguments for generate_func by using a lambda function e.g.
     generate_representation_all(df,
                                 lambda r: generate_padded_onehot_meiler(r, 4, 12))"""
-    example_rep = generate_func(bound_pairs_df.iloc[0])
-    representations = scipy.sparse.lil_matrix((len(bound_pairs_df), len(example_rep)))
-    for ind in range(len(bound_pairs_df)):
-        representation = generate_func(bound_pairs_df.iloc[ind])
-        representations[ind] = representation
+    example_rep = np.asarray(generate_func(bound_pairs_df.iloc[0]))
+
+    # Fill a preallocated dense array row by row - much cheaper than
+    #   assigning rows of a lil_matrix - and convert to sparse just once
+    representations = np.zeros((len(bound_pairs_df), len(example_rep)),
+                               dtype=example_rep.dtype)
+    representations[0] = example_rep
+    for ind in range(1, len(bound_pairs_df)):
+        representations[ind] = generate_func(bound_pairs_df.iloc[ind])
 
-    return representations
+    return scipy.sparse.csr_matrix(representations)
@@ -1,4 +1,5 @@
 """Utils functions for rational design"""
+import base64
 import csv
 import glob
 import logging
@@ -6,6 +7,7 @@ import json
 import os
 import re
 
+import numpy as np
 import pandas as pd
 
 
@@ -90,6 +92,24 @@ def sanitise_pdb_id(pdb_id):
     return sanitised
 
 
+def encode_bp_indices(indices):
+    """Encode a list of residue indices as a compact string: the indices are
+    packed as int32 and base64-encoded. Roughly a third of the size of the
+    JSON encoding previously used, with no JSON tokenizer on either side."""
+    return base64.b64encode(np.asarray(indices, dtype=np.int32).tobytes()).decode('ascii')
+
+
+def decode_bp_indices(bp_id_str):
+    """Decode a string of residue indices into a list of integers. Strings
+    starting with '[' are the old JSON encoding, which is still readable so
+    that existing csv files remain valid; anything else is the packed base64
+    encoding produced by encode_bp_indices."""
+    if bp_id_str.startswith('['):
+        return json.loads(bp_id_str)
+
+    return np.frombuffer(base64.b64decode(bp_id_str), dtype=np.int32).tolist()
+
+
 def get_bound_pair_id_from_row(row):
     """Generate an ID for a bound pair that will be unique across all bound pairs.
     The ID is of the form '{cdr_info}__{target_info}__{original_cdr_info}', where
@@ -99,18 +119,18 @@ def get_bound_pair_id_from_row(row):
         if this is a negative (no binding) example. It is omitted if there is no original CDR
         i.e. if the pair was observed to bind."""
     cdr_pdb_id = sanitise_pdb_id(row['cdr_pdb_id'])
-    cdr_indices = json.loads(row['cdr_bp_id_str'])
+    cdr_indices = decode_bp_indices(row['cdr_bp_id_str'])
     cdr_length = cdr_indices[-1] - cdr_indices[0] + 1
     cdr_info = f"{cdr_pdb_id}-{cdr_indices[0]}-{cdr_length}"
 
     target_pdb_id = sanitise_pdb_id(row['target_pdb_id'])
-    target_indices = json.loads(row['target_bp_id_str'])
+    target_indices = decode_bp_indices(row['target_bp_id_str'])
     target_length = target_indices[-1] - target_indices[0] + 1
     target_info = f"{target_pdb_id}-{target_indices[0]}-{target_length}"
 
     if not row['binding_observed']:
         original_cdr_pdb_id = sanitise_pdb_id(row['original_cdr_pdb_id'])
-        original_cdr_indices = json.loads(row['original_cdr_bp_id_str'])
+        original_cdr_indices = decode_bp_indices(row['original_cdr_bp_id_str'])
         original_cdr_length = original_cdr_indices[-1] - original_cdr_indices[0] + 1
         original_cdr_info = f"{original_cdr_pdb_id}-" \
             f"{original_cdr_indices[0]}-{original_cdr_length}"
@@ -127,29 +147,32 @@ def get_row_from_bound_pair_id(bound_pairs_df, bound_pair_id):
     An error will be raised if there is not precisely one row."""
     components = bound_pair_id.split("__")
 
+    # The data frame may hold either encoding of the indices (see
+    #   decode_bp_indices), so match against both
+    def index_strs(start_ind, length):
+        indices = list(range(int(start_ind), int(start_ind) + int(length)))
+        return [str(indices), encode_bp_indices(indices)]
+
     cdr_pdb_id, cdr_start_ind, cdr_length = components[0].split("-")
-    cdr_indices_str = str(list(range(int(cdr_start_ind),
-                                     int(cdr_start_ind) + int(cdr_length))))
+    cdr_indices_strs = index_strs(cdr_start_ind, cdr_length)
 
     target_pdb_id, target_start_ind, target_length = components[1].split("-")
-    target_indices_str = str(list(range(int(target_start_ind),
-                                        int(target_start_ind) + int(target_length))))
+    target_indices_strs = index_strs(target_start_ind, target_length)
 
     if len(components) == 3:
         original_cdr_pdb_id, original_cdr_start_ind, original_cdr_length = components[2].split("-")
-        o_cdr_indices_str = str(list(range(int(original_cdr_start_ind),
-                                           int(original_cdr_start_ind) + int(original_cdr_length))))
+        o_cdr_indices_strs = index_strs(original_cdr_start_ind, original_cdr_length)
         rows = bound_pairs_df[(bound_pairs_df['cdr_pdb_id'] == cdr_pdb_id) &
-                              (bound_pairs_df['cdr_bp_id_str'] == cdr_indices_str) &
+                              (bound_pairs_df['cdr_bp_id_str'].isin(cdr_indices_strs)) &
                               (bound_pairs_df['target_pdb_id'] == target_pdb_id) &
-                              (bound_pairs_df['target_bp_id_str'] == target_indices_str) &
+                              (bound_pairs_df['target_bp_id_str'].isin(target_indices_strs)) &
                               (bound_pairs_df['original_cdr_pdb_id'] == original_cdr_pdb_id) &
-                              (bound_pairs_df['original_cdr_bp_id_str'] == o_cdr_indices_str)]
+                              (bound_pairs_df['original_cdr_bp_id_str'].isin(o_cdr_indices_strs))]
     else:
         rows = bound_pairs_df[(bound_pairs_df['cdr_pdb_id'] == cdr_pdb_id) &
-                              (bound_pairs_df['cdr_bp_id_str'] == cdr_indices_str) &
+                              (bound_pairs_df['cdr_bp_id_str'].isin(cdr_indices_strs)) &
                               (bound_pairs_df['target_pdb_id'] == target_pdb_id) &
-                              (bound_pairs_df['target_bp_id_str'] == target_indices_str)]
+                              (bound_pairs_df['target_bp_id_str'].isin(target_indices_strs))]
 
     assert len(rows) == 1,\
         f"Query using id string {bound_pair_id} should only have returned one row, " \
@@ -98,6 +98,38 @@ class Test(unittest.TestCase):
         score = distances.calculate_alignment_score('PQQL', 'GGHS')
         self.assertEqual(score, -4)
 
+    def test_short_alignment_score_numba(self):
+        # Hand-computed scores with BLOSUM62, gapopen 0 and gapextend -1:
+        #   'PQQL' vs 'GGHS' matches the seq-align reference score above,
+        #   'QMSK' vs itself is the sum of the diagonal entries (5+5+4+5),
+        #   'AC' vs 'A' aligns A-A (4) and gaps the C (-1),
+        #   'KW' vs 'WK' gaps both ends (-2) to pair the W-W match (11)
+        scores = distances.calculate_alignment_scores_numba(
+            ['PQQL', 'QMSK', 'AC', 'KW'],
+            ['GGHS', 'QMSK', 'A', 'WK'])
+        self.assertEqual(list(scores), [-4, 19, 3, 9])
+
+    def test_short_alignment_score_numba_empty(self):
+        # An empty sequence forces an all-gap alignment: one gap per residue
+        #   of the other sequence, and zero when both are empty
+        encoded = [distances.encode_sequence(seq) for seq in ['QMSK', '', '']]
+        empties = [distances.encode_sequence(seq) for seq in ['', '', 'AC']]
+        scores = distances.calculate_alignment_scores_encoded(encoded, empties)
+        self.assertEqual(list(scores), [-4, 0, -2])
+
+    def test_short_alignment_lower_bound(self):
+        # The ungapped score is the score of one valid global alignment, so
+        #   it can never exceed the exact Needleman-Wunsch optimum
+        column_1 = [distances.encode_sequence(seq)
+                    for seq in self.df_dict['cdr_resnames'].values()]
+        column_2 = [distances.encode_sequence(seq)
+                    for seq in self.df_dict['target_resnames'].values()]
+        lower_bounds = distances.calculate_alignment_lower_bounds_encoded(column_1,
+                                                                          column_2)
+        exact_scores = distances.calculate_alignment_scores_encoded(column_1,
+                                                                    column_2)
+        self.assertTrue((lower_bounds <= exact_scores).all())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -93,6 +93,37 @@ class Test(unittest.TestCase):
                                                           min_fragment_length=1)
         self.assertEqual(fragments_11, expected_11)
 
+    def test_short_write_bound_pair_round_trip(self):
+        # Write a bound pair with the fixed-column formatter and check that
+        #   re-parsing the file recovers the same residues, atom for atom
+        filename = "tests/.tmp.bound_pair.pdb"
+        row = self.bound_pairs_df.iloc[1]
+        query_bp.write_bound_pair_to_pdb(row, filename)
+
+        parser = Bio.PDB.PDBParser(QUIET=True)
+        original = parser.get_structure("5waq", "cleanPDBs2/5waq.pdb")
+        cdr = query_bp.select_residues_from_compact_bp_id_string(row['cdr_bp_id_str'],
+                                                                 original)
+        target = query_bp.select_residues_from_compact_bp_id_string(row['target_bp_id_str'],
+                                                                    original)
+
+        written = parser.get_structure("pair", filename)
+        for chain_id, residues in [('C', cdr), ('T', target)]:
+            written_residues = list(written[0][chain_id].get_residues())
+            self.assertEqual(len(written_residues), len(residues))
+            for written_res, res in zip(written_residues, residues):
+                self.assertEqual(written_res.get_id(), res.get_id())
+                self.assertEqual(written_res.get_resname(), res.get_resname())
+                written_atoms = list(written_res.get_atoms())
+                atoms = list(res.get_atoms())
+                self.assertEqual([atom.get_name() for atom in written_atoms],
+                                 [atom.get_name() for atom in atoms])
+                np.testing.assert_allclose(np.array([atom.coord for atom in written_atoms]),
+                                           np.array([atom.coord for atom in atoms]),
+                                           atol=1e-3)
+
+        os.remove(filename)
+
     def test_short_write_all_bound_pairs_pdb(self):
         os.makedirs('processed/pdbs/')
         filenames = query_bp.write_all_bound_pairs_pdb(self.bound_pairs_df)